@@ -1,10 +1,10 @@
-from collections.abc import AsyncGenerator
 from contextlib import AsyncExitStack
 
 from aiobotocore.client import AioBaseClient
 from aiobotocore.session import AioSession
 from botocore.client import Config
 from environs import Env
+from fastapi import Request
 
 # Загружаем env
 env = Env()
@@ -35,12 +35,6 @@ async def create_async_client(session: AioSession, exit_stack: AsyncExitStack):
     return client
 
 
-async def get_async_client() -> AsyncGenerator[AioBaseClient, None]:
-    if not S3_ENABLED:
-        yield None
-        return
-        
-    session = AioSession()
-    async with AsyncExitStack() as exit_stack:
-        client = await create_async_client(session, exit_stack)
-        yield client
\ No newline at end of file
+async def get_async_client(request: Request) -> AioBaseClient | None:
+    # клиент один на всё приложение, он создаётся в lifespan
+    return request.app.state.boto_client
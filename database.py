@@ -15,7 +15,18 @@ env.read_env()
 
 # Используем SQLite по умолчанию, если POSTGRES_URL не указан
 database_url = env("POSTGRES_URL", "sqlite+aiosqlite:///./currency.db")
-engine = create_async_engine(database_url)
+
+# Пул соединений настраиваем только для PostgreSQL, у SQLite свой пул
+engine_kwargs = {}
+if not database_url.startswith("sqlite"):
+    engine_kwargs = {
+        "pool_size": 20,
+        "max_overflow": 40,
+        "pool_pre_ping": True,
+        "pool_recycle": 3600,
+        "pool_timeout": 30
+    }
+engine = create_async_engine(database_url, **engine_kwargs)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
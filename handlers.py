@@ -1,39 +1,82 @@
+import asyncio
+import csv
 import io
+import operator
 from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from contextlib import nullcontext
+from datetime import date, datetime
 from functools import cached_property
 from uuid import uuid4
 
 import logfire
-import pandas as pd
+import orjson
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import xlsxwriter
 from aiobotocore.client import AioBaseClient
-from environs import env
-from sqlalchemy.engine import ScalarResult
-
-from models import currency_columns
+from environs import Env
+from py_spoo_url import Shortener
+from sqlalchemy.engine import RowMapping
+
+from models import CurrencyRate, currency_columns
+
+# Загружаем env
+env = Env()
+env.read_env()
+
+# Без logfire спаны превращаются в пустые контекстные менеджеры
+span = logfire.span if env("LOGFIRE_TOKEN", None) else nullcontext
+
+# S3 опционален, поэтому бакет может быть не указан
+OBS_BUCKET = env("OBS_BUCKET", None)
+_shortener = Shortener()
+# pulls a row's values in the columns order with a single C-level call
+_row_getter = operator.itemgetter(*currency_columns)
+# fixed arrow types of the CurrencyRate table, so they aren't inferred;
+# an unmapped column type fails here instead of being dropped on export
+_arrow_types = {
+    int: pa.int64(),
+    str: pa.string(),
+    float: pa.float64(),
+    date: pa.date32(),
+    datetime: pa.timestamp("us")
+}
+RATE_SCHEMA = pa.schema([
+    (column.name, _arrow_types[column.type.python_type])
+    for column in CurrencyRate.__table__.columns
+])
 
 
 class ScalarsHandler(ABC):
     """
-    A base class for a handler that converts SQLAlchemy scalars to a specific
-    output format, uploads them to S3 bucket and generates a pre-signed
-    download link.
+    A base class for a handler that converts SQLAlchemy row mappings to
+    a specific output format, uploads them to S3 bucket and generates
+    a pre-signed download link.
     """
 
     def __init__(
         self,
-        scalars: list[ScalarResult],
+        rows: Sequence[RowMapping],
         botoclient: AioBaseClient,
         is_backup: bool
     ) -> None:
 
+        self.client = botoclient
+        self._rows = rows
+        self._is_backup = is_backup
+
+    @cached_property
+    def columns(self) -> dict[str, tuple]:
         # preserve columns order as they declared in the CurrencyRate table
-        with logfire.span("Make a dataframe from the scalars"):
-            records = [scalar.__dict__ for scalar in scalars]
-            self.df = pd.DataFrame.from_records(records)[currency_columns]
-        with logfire.span("Set the rest of the attributes"):
-            self.client = botoclient
-            self._is_backup = is_backup
-            self._body = io.BytesIO()
+        values = zip(*map(_row_getter, self._rows))
+        return dict(zip(currency_columns, values))
+
+    @cached_property
+    def table(self) -> pa.Table:
+        with span("Make an arrow table from the rows"):
+            return pa.Table.from_pydict(self.columns, schema=RATE_SCHEMA)
 
     @property
     @abstractmethod
@@ -47,7 +90,7 @@ class ScalarsHandler(ABC):
 
     @cached_property
     @abstractmethod
-    def body(self) -> io.BytesIO:
+    def body(self) -> bytes:
         raise NotImplementedError
 
     @cached_property
@@ -56,70 +99,93 @@ class ScalarsHandler(ABC):
         return f"{name}.{self.__class__.extension}"
 
     async def upload_contents(self) -> None:
-        with logfire.span("Make a format-specific object"):
-            self.body.seek(0)
-        with logfire.span("Put an object to a bucket"):
+        with span("Put an object to a bucket"):
             await self.client.put_object(
-                Bucket=env("OBS_BUCKET"),
+                Bucket=OBS_BUCKET,
                 Key=self.key,
                 Body=self.body,
+                ContentLength=len(self.body),
                 ContentType=self.__class__.content_type
             )
 
     async def generate_url(self) -> str:
-        with logfire.span("Generate a presigned url"):
+        with span("Generate a presigned url"):
             url = await self.client.generate_presigned_url(
                 ClientMethod="get_object",
                 Params={
-                    "Bucket": env("OBS_BUCKET"),
+                    "Bucket": OBS_BUCKET,
                     "Key": self.key
                 }
             )
-        with logfire.span("Shorten url and return it"):
-            from py_spoo_url import Shortener
-            return Shortener().shorten(url)
+        with span("Shorten url and return it"):
+            # the shortener is a blocking HTTP call
+            return await asyncio.to_thread(_shortener.shorten, url)
+
+
+OUTPUT_FORMATS: dict[str, type[ScalarsHandler]] = {}
+
 
+def register(cls: type[ScalarsHandler]) -> type[ScalarsHandler]:
+    """Make a handler available by its extension as an output format."""
+    OUTPUT_FORMATS[cls.extension] = cls
+    return cls
 
+
+@register
 class CSVMaker(ScalarsHandler):
     extension = "csv"
     content_type = "text/csv"
 
     @cached_property
-    def body(self) -> io.BytesIO:
-        self.df.to_csv(
-            self._body,
-            index=False,
-            encoding="utf-8"
+    def body(self) -> bytes:
+        # write rows straight from the mappings, without pandas
+        buffer = io.BytesIO()
+        wrapper = io.TextIOWrapper(
+            buffer, encoding="utf-8", newline="", write_through=True
         )
-        return self._body
+        writer = csv.writer(wrapper, lineterminator="\n")
+        writer.writerow(currency_columns)
+        writer.writerows(map(_row_getter, self._rows))
+        wrapper.detach()  # keep the buffer open when the wrapper is gone
+        return buffer.getvalue()
 
 
+@register
 class JSONMaker(ScalarsHandler):
     extension = "json"
     content_type = "application/json"
 
     @cached_property
-    def body(self) -> io.BytesIO:
-        self.df.to_json(
-            self._body,
-            orient="records",
-            date_format="iso",
-            force_ascii=False,
-            indent=4
-        )
-        return self._body
+    def body(self) -> bytes:
+        records = [dict(row) for row in self._rows]
+        return orjson.dumps(records, option=orjson.OPT_INDENT_2)
 
 
+@register
 class ParquetMaker(ScalarsHandler):
     extension = "parquet"
     content_type = "application/vnd.apache.parquet"
 
     @cached_property
-    def body(self) -> io.BytesIO:
-        self.df.to_parquet(self._body, index=False)
-        return self._body
+    def body(self) -> bytes:
+        buffer = io.BytesIO()
+        pq.write_table(self.table, buffer, compression="zstd")
+        return buffer.getvalue()
 
 
+@register
+class FeatherMaker(ScalarsHandler):
+    extension = "feather"
+    content_type = "application/vnd.apache.arrow.file"
+
+    @cached_property
+    def body(self) -> bytes:
+        buffer = io.BytesIO()
+        feather.write_feather(self.table, buffer, compression="zstd")
+        return buffer.getvalue()
+
+
+@register
 class XlsxMaker(ScalarsHandler):
     extension = "xlsx"
     content_type = (
@@ -127,7 +193,25 @@ class XlsxMaker(ScalarsHandler):
     )
 
     @cached_property
-    def body(self) -> io.BytesIO:
-        with pd.ExcelWriter(self._body) as writer:
-            self.df.to_excel(writer, index=False)
-        return self._body
\ No newline at end of file
+    def body(self) -> bytes:
+        # constant_memory flushes every finished row, so rows must be
+        # written whole and in order
+        buffer = io.BytesIO()
+        options = {
+            "constant_memory": True,
+            "use_zip64": True,
+            "default_date_format": "yyyy-mm-dd"
+        }
+        with xlsxwriter.Workbook(buffer, options) as workbook:
+            datetime_format = workbook.add_format(
+                {"num_format": "yyyy-mm-dd hh:mm:ss"}
+            )
+            timestamp = currency_columns.index("timestamp")
+            worksheet = workbook.add_worksheet("rates")
+            worksheet.write_row(0, 0, currency_columns)
+            for i, row in enumerate(self._rows, start=1):
+                worksheet.write_row(i, 0, _row_getter(row))
+                worksheet.write_datetime(
+                    i, timestamp, row["timestamp"], datetime_format
+                )
+        return buffer.getvalue()
@@ -9,7 +9,11 @@ env.read_env()
 # Настройка Logfire только если токен указан
 logfire_token = env("LOGFIRE_TOKEN", None)
 if logfire_token:
-    logfire.configure(token=logfire_token, service_name="Currency-API")
+    logfire.configure(
+        token=logfire_token,
+        service_name="Currency-API",
+        inspect_arguments=False
+    )
     logfire.install_auto_tracing(
         modules=["main", "handlers"],
         min_duration=0
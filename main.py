@@ -1,22 +1,31 @@
+import asyncio
+import hmac
 import operator
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 from typing import Annotated
 import os
 
 import fastapi
 import logfire
 from aiobotocore.client import AioBaseClient
+from aiobotocore.session import AioSession
 from environs import Env
-from fastapi import Depends, FastAPI, HTTPException, Query, status
+from fastapi import (
+    BackgroundTasks, Depends, FastAPI, HTTPException, Query, status
+)
 from fastapi.security import APIKeyHeader
-from sqlalchemy import cast, Date, delete, select
+from sqlalchemy import delete, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from starlette.responses import RedirectResponse
 
 import schemas
-from botocore_client import get_async_client
-from database import create_all_tables, get_async_session
-from models import CurrencyRate
+from botocore_client import create_async_client, get_async_client
+from database import (
+    async_session_maker, create_all_tables, get_async_session
+)
+from handlers import span
+from models import CurrencyRate, currency_columns
 from schemas import available_output_formats, Request, Response
 
 # Загружаем env
@@ -25,20 +34,26 @@ env.read_env()
 
 DBSession = Annotated[AsyncSession, Depends(get_async_session)]
 BotoClient = Annotated[AioBaseClient, Depends(get_async_client)]
-backup_request = Request(isBackup=True)
+# бэкап остаётся в parquet, чтобы его ключ не менялся
+backup_request = Request(isBackup=True, outputFormat="parquet")
+EXPECTED_TOKEN = env("API_TOKEN", "default_token_for_development").encode()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_all_tables()
-    yield
+    # один S3-клиент на всё приложение, чтобы переиспользовать соединения
+    async with AsyncExitStack() as exit_stack:
+        app.state.boto_client = await create_async_client(
+            AioSession(), exit_stack
+        )
+        yield
 
 
 async def api_token(
     token: Annotated[str, Depends(APIKeyHeader(name="API-Token"))]
 ) -> None:
-    expected_token = env("API_TOKEN", "default_token_for_development")
-    if token != expected_token:
+    if not hmac.compare_digest(token.encode(), EXPECTED_TOKEN):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
 
 
@@ -55,12 +70,23 @@ app = FastAPI(
 # Настройка Logfire только если токен указан
 logfire_token = env("LOGFIRE_TOKEN", None)
 if logfire_token:
-    logfire.configure(token=logfire_token, service_name="Currency-API")
+    logfire.configure(
+        token=logfire_token,
+        service_name="Currency-API",
+        inspect_arguments=False
+    )
     logfire.instrument_fastapi(app, capture_headers=True)
 else:
     print("Logfire not configured, continuing without logging")
 
 
+async def make_backup(client: AioBaseClient) -> None:
+    # сессия запроса к этому моменту уже закрыта, поэтому открываем свою
+    with span("Make a database backup"):
+        async with async_session_maker() as session:
+            await get_currency_rates(backup_request, session, client)
+
+
 @app.get("/")
 async def redirect_from_root_to_docs():
     return RedirectResponse(url="/docs")
@@ -72,70 +98,45 @@ async def redirect_from_root_to_docs():
     status_code=status.HTTP_201_CREATED
 )
 async def post_currency_rates(
-    rates: list[schemas.CurrencyRate], session: DBSession, client: BotoClient
+    rates: list[schemas.CurrencyRate],
+    session: DBSession,
+    client: BotoClient,
+    background_tasks: BackgroundTasks
 ):
-    # Используем logfire только если настроен
-    if logfire_token:
-        with logfire.span("Create new entries"):
-            rates = [CurrencyRate(**rate.model_dump()) for rate in rates]
-        with logfire.span("Add entries and commit"):
-            session.add_all(rates)
-            await session.commit()
-        with logfire.span("Make a database backup"):
-            await get_currency_rates(backup_request, session, client)
-    else:
+    with span("Create new entries"):
         rates = [CurrencyRate(**rate.model_dump()) for rate in rates]
+    with span("Add entries and commit"):
         session.add_all(rates)
         await session.commit()
-        await get_currency_rates(backup_request, session, client)
+    background_tasks.add_task(make_backup, client)
 
 
 @app.get("/currency-rates")
 async def get_currency_rates(
     r: Annotated[Request, Query()], session: DBSession, client: BotoClient
 ):
-    if logfire_token:
-        with logfire.span("Select entries"):
-            dates = cast(CurrencyRate.date, Date)
-            clauses = [(r.startDate, operator.ge), (r.endDate, operator.le)]
-            clauses = [func(dates, date) for date, func in clauses if date]
-            columns = [CurrencyRate.date, CurrencyRate.letter_code]
-            statement = select(CurrencyRate).where(*clauses).order_by(*columns)
-            result = await session.execute(statement)
-
-        with logfire.span("Pick a handler, handle entries, return a response"):
-            if not (scalars := result.scalars().all()):
-                return Response(**r.model_dump(), comment="No results")
-
-            handler_class = available_output_formats[r.outputFormat]
-            handler = handler_class(scalars, client, r.isBackup)
-            await handler.upload_contents()
-
-            if r.isBackup:
-                return fastapi.Response(status_code=status.HTTP_204_NO_CONTENT)
-
-            shortened_presigned_url = await handler.generate_url()
-            return Response(**r.model_dump(), url=shortened_presigned_url)
-    else:
-        # Без logfire
-        dates = cast(CurrencyRate.date, Date)
+    with span("Select entries"):
         clauses = [(r.startDate, operator.ge), (r.endDate, operator.le)]
-        clauses = [func(dates, date) for date, func in clauses if date]
+        clauses = [op(CurrencyRate.date, date) for date, op in clauses if date]
         columns = [CurrencyRate.date, CurrencyRate.letter_code]
-        statement = select(CurrencyRate).where(*clauses).order_by(*columns)
+        selected = [getattr(CurrencyRate, c) for c in currency_columns]
+        statement = select(*selected).where(*clauses).order_by(*columns)
         result = await session.execute(statement)
 
-        if not (scalars := result.scalars().all()):
+    with span("Pick a handler, handle entries, return a response"):
+        if not (rows := result.mappings().all()):
             return Response(**r.model_dump(), comment="No results")
 
         handler_class = available_output_formats[r.outputFormat]
-        handler = handler_class(scalars, client, r.isBackup)
-        await handler.upload_contents()
-
+        handler = handler_class(rows, client, r.isBackup)
         if r.isBackup:
+            await handler.upload_contents()
             return fastapi.Response(status_code=status.HTTP_204_NO_CONTENT)
 
-        shortened_presigned_url = await handler.generate_url()
+        # presigning doesn't need the object to exist, so run it alongside
+        _, shortened_presigned_url = await asyncio.gather(
+            handler.upload_contents(), handler.generate_url()
+        )
         return Response(**r.model_dump(), url=shortened_presigned_url)
 
 
@@ -145,20 +146,16 @@ async def get_currency_rates(
     status_code=status.HTTP_204_NO_CONTENT
 )
 async def delete_currency_rates(
-    delete_ids: list[int], session: DBSession, client: BotoClient
+    delete_ids: list[int],
+    session: DBSession,
+    client: BotoClient,
+    background_tasks: BackgroundTasks
 ):
-    if logfire_token:
-        with logfire.span("Delete entries and commit"):
-            statement = delete(CurrencyRate).where(CurrencyRate.id.in_(delete_ids))
-            await session.execute(statement)
-            await session.commit()
-        with logfire.span("Make a database backup"):
-            await get_currency_rates(backup_request, session, client)
-    else:
+    with span("Delete entries and commit"):
         statement = delete(CurrencyRate).where(CurrencyRate.id.in_(delete_ids))
         await session.execute(statement)
         await session.commit()
-        await get_currency_rates(backup_request, session, client)
+    background_tasks.add_task(make_backup, client)
 
 
 @app.get("/currency-rates/latest")
@@ -170,61 +167,26 @@ async def get_latest_rates(
     Get latest currency rates for specified currencies.
     If no currencies specified, returns all latest rates.
     """
-    if logfire_token:
-        with logfire.span("Get latest rates"):
-            # Subquery to get latest date for each currency
-            subquery = (
-                select(
-                    CurrencyRate.letter_code,
-                    CurrencyRate.date,
-                    CurrencyRate.exchange_rate
-                )
-                .order_by(
-                    CurrencyRate.letter_code,
-                    CurrencyRate.date.desc()
-                )
-                .distinct(CurrencyRate.letter_code)
-                .subquery()
+    with span("Get latest rates"):
+        # Number each currency's rates from the latest date backwards,
+        # the most recently posted rate wins within the same date
+        row_number = func.row_number().over(
+            partition_by=CurrencyRate.letter_code,
+            order_by=(
+                CurrencyRate.date.desc(),
+                CurrencyRate.timestamp.desc(),
+                CurrencyRate.id.desc()
             )
-
-            # Main query
-            statement = select(CurrencyRate).join(
-                subquery,
-                (CurrencyRate.letter_code == subquery.c.letter_code) &
-                (CurrencyRate.date == subquery.c.date) &
-                (CurrencyRate.exchange_rate == subquery.c.exchange_rate)
-            )
-
-            if currency_codes:
-                statement = statement.where(CurrencyRate.letter_code.in_(currency_codes))
-
-            result = await session.execute(statement)
-            rates = result.scalars().all()
-    else:
-        # Без logfire
-        subquery = (
-            select(
-                CurrencyRate.letter_code,
-                CurrencyRate.date,
-                CurrencyRate.exchange_rate
-            )
-            .order_by(
-                CurrencyRate.letter_code,
-                CurrencyRate.date.desc()
-            )
-            .distinct(CurrencyRate.letter_code)
-            .subquery()
-        )
-
-        statement = select(CurrencyRate).join(
-            subquery,
-            (CurrencyRate.letter_code == subquery.c.letter_code) &
-            (CurrencyRate.date == subquery.c.date) &
-            (CurrencyRate.exchange_rate == subquery.c.exchange_rate)
         )
+        subquery = select(CurrencyRate, row_number.label("rn"))
 
         if currency_codes:
-            statement = statement.where(CurrencyRate.letter_code.in_(currency_codes))
+            subquery = subquery.where(CurrencyRate.letter_code.in_(currency_codes))
+
+        # Main query
+        subquery = subquery.subquery()
+        latest = aliased(CurrencyRate, subquery)
+        statement = select(latest).where(subquery.c.rn == 1)
 
         result = await session.execute(statement)
         rates = result.scalars().all()
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import DateTime, Integer, MetaData, String, Text, Float, Date
+from sqlalchemy import DateTime, Index, Integer, MetaData, String, Text, Float, Date
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
 
 
@@ -22,5 +22,12 @@ class CurrencyRate(Base):
     timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     source: Mapped[str] = mapped_column(String(50), nullable=False, default='cbr.ru')
 
+    __table_args__ = (
+        # date range scans ordered by (date, letter_code)
+        Index("ix_rate_date_letter", "date", "letter_code"),
+        # latest rate per currency
+        Index("ix_rate_letter_date_desc", "letter_code", date.desc()),
+    )
+
 
 currency_columns = CurrencyRate.__table__.columns.keys()
\ No newline at end of file
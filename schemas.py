@@ -1,17 +1,11 @@
-import inspect
 from datetime import date, datetime
 from typing import Annotated, Literal
 
 from pydantic import BaseModel, Field, field_validator
 
-import handlers
+from handlers import OUTPUT_FORMATS as available_output_formats
 
 
-available_output_formats = {
-    obj.extension: obj
-    for name, obj in inspect.getmembers(handlers)
-    if name.endswith("Maker")
-}
 outputFormats = Literal[tuple(available_output_formats)]
 date_value = str | date | None
 
@@ -40,7 +34,7 @@ class CurrencyRate(BaseModel):
 class Request(BaseModel):
     startDate: date_value = None
     endDate: date_value = None
-    outputFormat: outputFormats = "parquet"  # type: ignore
+    outputFormat: outputFormats = "feather"  # type: ignore
     isBackup: Annotated[bool, Field(exclude=True)] = False
 
     @field_validator("startDate", "endDate", mode="before")
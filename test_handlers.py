@@ -0,0 +1,56 @@
+import io
+from datetime import date, datetime
+
+import openpyxl
+import orjson
+import pyarrow.parquet as pq
+
+from handlers import JSONMaker, ParquetMaker, XlsxMaker
+from models import currency_columns
+
+rows = [
+    {
+        "id": i,
+        "digital_code": "840",
+        "letter_code": "USD",
+        "units": 1,
+        "currency_name": "Доллар США",
+        "exchange_rate": 90.5 + i,
+        "date": date(2024, 1, i),
+        "timestamp": datetime(2024, 1, i, 12, 30),
+        "source": "cbr.ru"
+    }
+    for i in range(1, 4)
+]
+
+
+def test_xlsx_keeps_every_cell():
+    body = XlsxMaker(rows, None, False).body
+    sheet = openpyxl.load_workbook(io.BytesIO(body))["rates"]
+    header, *values = sheet.iter_rows(values_only=True)
+
+    assert list(header) == currency_columns
+    assert len(values) == len(rows)
+    for value, row in zip(values, rows):
+        expected = [row[column] for column in currency_columns]
+        expected[currency_columns.index("date")] = datetime.combine(
+            row["date"], datetime.min.time()
+        )
+        assert list(value) == expected
+
+
+def test_json_keeps_naive_timestamps():
+    body = JSONMaker(rows, None, False).body
+    record = orjson.loads(body)[0]
+
+    assert list(record) == currency_columns
+    assert record["date"] == "2024-01-01"
+    assert record["timestamp"] == "2024-01-01T12:30:00"
+
+
+def test_arrow_schema_covers_every_column():
+    body = ParquetMaker(rows, None, False).body
+    table = pq.read_table(io.BytesIO(body))
+
+    assert table.schema.names == currency_columns
+    assert table.to_pylist() == rows